@@ -1,18 +1,22 @@
 import streamlit as st
-from modules.healy import Healy # Assuming this is your custom module
-from azure.cosmos import CosmosClient
 from dotenv import load_dotenv
+
+# Load environment variables before local modules read their settings
+load_dotenv()
+
+from utils.password_handler import hash_password, hash_password_async, check_password, needs_rehash
 from streamlit_cookies_manager import EncryptedCookieManager
 import os
-import bcrypt
+import re
 import uuid
-from datetime import datetime
-import json
-import pandas as pd
-import io
-
-# Load environment variables
-load_dotenv()
+from datetime import datetime, timezone
+import hashlib
+import hmac
+import secrets
+import base64
+import msgpack
+import threading
+from cachetools import TTLCache
 
 # Initialize Streamlit page
 st.set_page_config(page_title="Healy", layout="wide")
@@ -23,48 +27,248 @@ cookies = EncryptedCookieManager(
     password=os.getenv("COOKIE_PASSWORD", "default-cookie-password")
 )
 
-if not cookies.ready():
+# Cookies are only read to restore a session, so once this session knows
+# whether it's logged in there's nothing to wait for (or decrypt)
+if "logged_in" not in st.session_state and not cookies.ready():
     # Wait for cookies to be ready
     st.spinner("Loading session...")
     st.stop()
 
-# Initialize Cosmos client
-try:
-    client = CosmosClient(os.getenv("COSMOS_URI"), credential=os.getenv("COSMOS_KEY"))
+SPROC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sprocs")
+STORED_PROCEDURES = ["appendProgress", "registerIfAbsent", "recordLogin", "revokeSessionToken"]
+
+def _ensure_stored_procedure(container, sproc_id: str):
+    from azure.cosmos import exceptions
+    with open(os.path.join(SPROC_DIR, f"{sproc_id}.js"), encoding="utf-8") as f:
+        body = {"id": sproc_id, "body": f.read()}
+    try:
+        container.scripts.create_stored_procedure(body=body)
+    except exceptions.CosmosResourceExistsError:
+        container.scripts.replace_stored_procedure(sproc=sproc_id, body=body)
+
+# Shared clients - st.cache_resource keeps one live instance (and its
+# connection pool) per server process instead of rebuilding it every rerun
+@st.cache_resource
+def get_cosmos_container():
+    # Imported here so the anonymous welcome page never loads the Cosmos SDK
+    from azure.cosmos import CosmosClient, PartitionKey
+    from azure.core.pipeline.transport import RequestsTransport
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    # Size the connection pool for concurrent sessions instead of requests' default of 10.
+    # Retries stay off at this layer, as in azure-core's own sessions - the SDK's
+    # retry policies already retry, and stacking urllib3 retries under them
+    # would multiply the wait during an outage.
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=20,
+        pool_maxsize=100,
+        max_retries=Retry(total=False, redirect=False, raise_on_status=False)
+    ))
+    client = CosmosClient(
+        os.getenv("COSMOS_URI"),
+        credential=os.getenv("COSMOS_KEY"),
+        connection_verify=True,
+        transport=RequestsTransport(session=session, session_owner=False)
+    )
     database = client.get_database_client(os.getenv("DATABASE_NAME"))
-    container = database.get_container_client(os.getenv("CONTAINER_NAME"))
-except Exception as e:
-    st.error(f"Failed to connect to database: {str(e)}")
-    st.stop()
+    # Login looks users up by email, so partition on it to route those queries
+    # to a single partition. Unique keys are enforced per logical partition,
+    # which with an /email key makes /email unique container-wide.
+    container = database.create_container_if_not_exists(
+        id=os.getenv("CONTAINER_NAME"),
+        partition_key=PartitionKey(path="/email"),
+        unique_key_policy={"uniqueKeys": [{"paths": ["/email"]}]}
+    )
+    # An existing container is returned as-is whatever its partition key, and
+    # one created on another key (e.g. /id) would send every email-keyed read
+    # and write to the wrong partition
+    paths = container.read()["partitionKey"]["paths"]
+    if paths != ["/email"]:
+        raise RuntimeError(
+            f"container '{container.id}' is partitioned on {paths}, expected ['/email']. "
+            "Copy it with `python -m utils.migrate_partition_key` and point CONTAINER_NAME at the new container."
+        )
+    for sproc_id in STORED_PROCEDURES:
+        _ensure_stored_procedure(container, sproc_id)
+    return container
+
+@st.cache_resource
+def get_healy():
+    from modules.healy import Healy
+    return Healy()
+
+# Identical prompts (same question + same profile/CSV context) get the same
+# advice, so skip the model call for repeats. Responses are streamed, so this
+# is a process-wide cache filled after streaming rather than st.cache_data.
+@st.cache_resource
+def get_response_cache():
+    return TTLCache(maxsize=1024, ttl=3600), threading.Lock()
+
+def stream_cached_response(prompt: str, user_context: str, history: list) -> str:
+    """Render the AI response to prompt, streaming it unless cached; returns the full text"""
+    cache, lock = get_response_cache()
+    # Key on exactly what the model sees: profile, recent history and the prompt
+    recent = history[-get_healy().HISTORY_MESSAGES:]
+    key_parts = [user_context, *(f"{m['role']}:{m['content']}" for m in recent), prompt]
+    prompt_hash = hashlib.blake2b("\0".join(key_parts).encode('utf-8'), digest_size=16).hexdigest()
+    with lock:
+        response = cache.get(prompt_hash)
+    if response is not None:
+        st.markdown(response)
+        return response
+
+    failed = False
+    def chunks():
+        nonlocal failed
+        try:
+            yield from get_healy().stream_response(prompt, user_context, recent)
+        except Exception as e: # May come after part of the reply was already shown
+            failed = True
+            yield f"Error: {str(e)}"
+
+    response = st.write_stream(chunks()) or ""
+    if response and not failed: # Only cache complete replies
+        with lock:
+            cache[prompt_hash] = response
+    return response
+
+def get_container():
+    """Cosmos container, connected on first use"""
+    try:
+        return get_cosmos_container()
+    except Exception as e:
+        st.error(f"Failed to connect to database: {str(e)}")
+        st.stop()
+
+def _utcnow_iso() -> str:
+    """Current UTC time as an ISO 8601 string, for the timestamps stored on user documents"""
+    return datetime.now(timezone.utc).isoformat()
+
+# The users container is partitioned on /email
+def _partition_key(user: dict) -> str:
+    return user["email"]
+
+def _user_record(doc: dict) -> dict:
+    """Build the session-facing user dict from a Cosmos user document"""
+    return {
+        "id": doc.get("id"),
+        "username": doc.get("username"),
+        "email": doc.get("email"),
+        "birthdate": doc.get("birthdate"),
+        "weight": doc.get("weight"),
+        "height": doc.get("height"),
+        "health_metrics": doc.get("health_metrics", {
+            "initial_weight": doc.get("weight"), # ensure these are populated if missing
+            "initial_height": doc.get("height"),
+            "progress": []
+        })
+    }
+
+# The session cookie only carries what's needed to find the user again; the
+# profile itself is re-read from Cosmos. msgpack keeps it smaller than JSON.
+# Each login mints a random session token for the cookie; the user document
+# only keeps its sha256, for the most recent MAX_SESSION_TOKENS logins so
+# other devices stay signed in
+MAX_SESSION_TOKENS = 5
+
+def _token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+def _encode_session_cookie(user: dict, token: str) -> str:
+    payload = {"id": user["id"], "email": user["email"], "username": user["username"], "token": token}
+    return base64.urlsafe_b64encode(msgpack.packb(payload)).decode('ascii')
+
+def _decode_session_cookie(value: str) -> dict:
+    return msgpack.unpackb(base64.urlsafe_b64decode(value.encode('ascii')))
+
+def _clear_cookie():
+    # save() re-encrypts the whole jar, so only call it when something was removed
+    if "user" in cookies:
+        del cookies["user"]
+        cookies.save()
+
+def _read_user(user_id: str, partition_key: str):
+    """Uncached point read, returns (profile record, session token hashes) or None"""
+    from azure.cosmos import exceptions
+    # Point read: cheapest Cosmos operation, no cross-partition fan-out
+    try:
+        db_user = get_container().read_item(item=user_id, partition_key=partition_key)
+    except exceptions.CosmosResourceNotFoundError:
+        return None
+    # Only the profile fields and token hashes, never the password hash
+    return _user_record(db_user), db_user.get("session_tokens", [])
+
+def _session_token_valid(token: str, session_tokens: list) -> bool:
+    token_hash = _token_hash(token)
+    return any(hmac.compare_digest(token_hash, h) for h in session_tokens)
+
+# Cached user lookups - Streamlit reruns the whole script on every interaction,
+# so these keep repeated reruns from hitting Cosmos each time
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_user_by_id(user_id: str, partition_key: str):
+    return _read_user(user_id, partition_key)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_user_by_email(email: str):
+    query = (
+        "SELECT TOP 1 c.id, c.password_hash, c.username, c.email, c.birthdate, c.weight, c.height, c.health_metrics "
+        "FROM c WHERE c.email = @email"
+    )
+    params = [{"name": "@email", "value": email}]
+    # Take the first page's first item and stop, instead of draining every page
+    users = get_container().query_items(
+        query=query,
+        parameters=params,
+        max_item_count=1,
+        partition_key=email
+    )
+    return next(iter(users), None)
+
+# The token list is read and written server-side, so concurrent logins and
+# logouts on other devices can't overwrite each other's hashes
+def _record_login(user: dict, token: str, extra_fields=None):
+    """Set last_login (plus any extra_fields) and add the session token hash in one transaction"""
+    get_container().scripts.execute_stored_procedure(
+        sproc="recordLogin",
+        partition_key=_partition_key(user),
+        params=[user["id"], _token_hash(token), MAX_SESSION_TOKENS, {"last_login": _utcnow_iso(), **(extra_fields or {})}]
+    )
 
-# Password hashing functions
-def hash_password(password: str) -> bytes:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+def _revoke_session_token(user: dict, token: str):
+    """Drop this session's token hash from the user document"""
+    get_container().scripts.execute_stored_procedure(
+        sproc="revokeSessionToken",
+        partition_key=_partition_key(user),
+        params=[user["id"], _token_hash(token)]
+    )
 
-def check_password(password: str, hashed: bytes) -> bool:
-    return bcrypt.checkpw(password.encode('utf-8'), hashed)
+def _username_taken(username: str) -> bool:
+    # username isn't the partition key, so this query has to fan out
+    result = get_container().query_items(
+        query="SELECT VALUE COUNT(1) FROM c WHERE c.username = @username",
+        parameters=[{"name": "@username", "value": username}],
+        max_item_count=1,
+        enable_cross_partition_query=True
+    )
+    return next(iter(result)) > 0
 
 # Register a new user with additional health metrics
 def register_user(username: str, email: str, password: str, birthdate: str, weight: float, height: float) -> bool:
+    from azure.cosmos import exceptions
     try:
-        # Check if username or email already exists
-        query = "SELECT * FROM c WHERE c.username = @username OR c.email = @email"
-        params = [
-            {"name": "@username", "value": username},
-            {"name": "@email", "value": email}
-        ]
-        existing_users = list(container.query_items(
-            query=query,
-            parameters=params,
-            enable_cross_partition_query=True
-        ))
-        
-        if existing_users:
+        # Hash while the existence check is in flight; thrown away if the user exists
+        hash_future = hash_password_async(password)
+
+        # Email is checked inside registerIfAbsent below
+        if _username_taken(username):
+            hash_future.cancel()
             st.error("Username or email already exists.")
             return False
 
-        # Hash the password
-        password_hash = hash_password(password)
+        password_hash = hash_future.result()
 
         # Create user document with health metrics
         user_doc = {
@@ -75,7 +279,7 @@ def register_user(username: str, email: str, password: str, birthdate: str, weig
             "birthdate": birthdate,
             "weight": weight,
             "height": height,
-            "created_at": datetime.utcnow().isoformat(),
+            "created_at": _utcnow_iso(),
             "last_login": None,
             "health_metrics": {
                 "initial_weight": weight,
@@ -84,29 +288,54 @@ def register_user(username: str, email: str, password: str, birthdate: str, weig
             }
         }
 
-        container.create_item(body=user_doc)
+        # Email check and insert in one transactional round-trip
+        created = get_container().scripts.execute_stored_procedure(
+            sproc="registerIfAbsent",
+            partition_key=email,
+            params=[user_doc]
+        )
+        if not created:
+            st.error("Username or email already exists.")
+            return False
+
+        _fetch_user_by_email.clear() # Drop any cached "not found" for this email
         return True
+    except exceptions.CosmosResourceExistsError: # Email unique key caught a concurrent registration
+        st.error("Username or email already exists.")
+        return False
     except Exception as e:
         st.error(f"Registration failed: {str(e)}")
         return False
 
+# Nothing writes progress entries yet; this is the batched writer for when something does
+def append_progress(user: dict, entries: list) -> int:
+    """Append entries to health_metrics.progress server-side, returns the new progress length"""
+    return get_container().scripts.execute_stored_procedure(
+        sproc="appendProgress",
+        partition_key=_partition_key(user),
+        params=[user["id"], entries]
+    )
+
+# Keyed on the raw bytes, so re-uploading the same file skips parsing
+@st.cache_data(show_spinner=False)
+def _parse_csv(bytes_payload: bytes):
+    from utils import csv_handler # Only loads pandas once a CSV is actually uploaded
+    return csv_handler.parse_csv(bytes_payload)
+
+# value_counts over a text column is a full pass, so it only runs for columns
+# the user actually asks about
+@st.cache_data(show_spinner=False)
+def _top_values(bytes_payload: bytes, column: str, n: int = 3) -> dict:
+    from utils import csv_handler
+    return csv_handler.top_values(bytes_payload, column, n)
+
 def process_csv_file(uploaded_file):
     """Process uploaded CSV file and return DataFrame and summary"""
     try:
-        # Read CSV file
-        df = pd.read_csv(uploaded_file)
-        
-        # Get basic info about the CSV
-        csv_info = {
-            "filename": uploaded_file.name,
-            "shape": df.shape,
-            "columns": df.columns.tolist(),
-            "dtypes": {col: str(dtype) for col, dtype in df.dtypes.to_dict().items()}, # ensure serializable
-            "head": df.head().to_dict('records'),
-            "null_counts": {col: int(count) for col, count in df.isnull().sum().to_dict().items()}, # ensure serializable
-            "summary_stats": df.describe(include='all').to_dict() if not df.empty else {} # include all, ensure serializable
-        }
-        
+        bytes_payload = uploaded_file.getvalue()
+        df, csv_info = _parse_csv(bytes_payload)
+        csv_info["filename"] = uploaded_file.name # cache_data hands back a copy, safe to extend
+        csv_info["bytes_payload"] = bytes_payload # For lazy per-column stats
         return df, csv_info
     except Exception as e:
         st.error(f"Error processing CSV file: {str(e)}")
@@ -117,15 +346,15 @@ def format_csv_for_prompt(df, csv_info, user_question=""):
     # Ensure data types are strings for the prompt
     dtypes_str = "\n".join([f"- {col}: {dtype}" for col, dtype in csv_info['dtypes'].items()])
     missing_values_str = "\n".join([f"- {col}: {count} missing" for col, count in csv_info['null_counts'].items() if count > 0]) or "No missing values"
-    
-    # Handle potentially large summary_stats by converting to string representation
-    summary_stats_str = ""
-    if csv_info['summary_stats']:
-        try:
-            summary_stats_df = pd.DataFrame(csv_info['summary_stats'])
-            summary_stats_str = f"Summary Statistics:\n{summary_stats_df.to_string()}"
-        except Exception:
-            summary_stats_str = f"Summary Statistics (raw):\n{json.dumps(csv_info['summary_stats'], indent=2)}"
+
+    question = user_question.lower()
+    top_values_str = "\n".join(
+        f"- {col}: " + ", ".join(f"{value} ({count})" for value, count in _top_values(csv_info['bytes_payload'], col).items())
+        for col in csv_info['categorical_columns']
+        if re.search(rf"(?<!\w){re.escape(str(col).lower())}(?!\w)", question) # Whole words, so "values" doesn't pick Value
+    )
+    if top_values_str:
+        top_values_str = f"Most Common Values:\n{top_values_str}"
 
 
     prompt_text = f"""
@@ -135,8 +364,8 @@ File: {csv_info['filename']}
 Shape: {csv_info['shape'][0]} rows × {csv_info['shape'][1]} columns
 Columns: {', '.join(csv_info['columns'])}
 
-Data Preview (first 5 rows):
-{pd.DataFrame(csv_info['head']).to_string(index=False)}
+Data Preview (first {csv_info['preview_rows']} rows):
+{csv_info['head_str']}
 
 Data Types:
 {dtypes_str}
@@ -144,7 +373,9 @@ Data Types:
 Missing Values:
 {missing_values_str}
 
-{summary_stats_str}
+{csv_info['summary_stats_str']}
+
+{top_values_str}
 
 User Question: {user_question}
 
@@ -154,46 +385,38 @@ Please analyze this data and provide insights based on the user's question. If i
 
 def login_user(email: str, password: str) -> bool:
     try:
-        query = "SELECT * FROM c WHERE c.email = @email"
-        params = [{"name": "@email", "value": email}]
-        users = list(container.query_items(
-            query=query,
-            parameters=params,
-            enable_cross_partition_query=True
-        ))
+        user = _fetch_user_by_email(email)
         
-        if not users:
+        if user is None:
             st.error("User not found.")
             return False
 
-        user = users[0]
         stored_hash = user.get("password_hash", "").encode('utf-8')
 
         if check_password(password, stored_hash):
-            # Update last login time
-            user["last_login"] = datetime.utcnow().isoformat()
-            container.upsert_item(user)
+            # Migrate hashes made with a different cost now that we have the plaintext
+            rehash_fields = None
+            if needs_rehash(stored_hash):
+                rehash_fields = {"password_hash": hash_password(password).decode('utf-8')}
+
+            # Update last login time, the session token (and the migrated hash) in one call
+            token = secrets.token_urlsafe(32)
+            _record_login(user, token, rehash_fields)
+            if rehash_fields:
+                _fetch_user_by_email.clear()
+            # Cached restores would still hold the old token list
+            _fetch_user_by_id.clear()
             
             # Store user info including health metrics
-            user_data = {
-                "id": user.get("id"),
-                "username": user.get("username"),
-                "email": user.get("email"),
-                "birthdate": user.get("birthdate"),
-                "weight": user.get("weight"),
-                "height": user.get("height"),
-                "health_metrics": user.get("health_metrics", {
-                    "initial_weight": user.get("weight"), # ensure these are populated if missing
-                    "initial_height": user.get("height"),
-                    "progress": []
-                })
-            }
+            user_data = _user_record(user)
             st.session_state.user = user_data
             st.session_state.logged_in = True
+            st.session_state.session_token = token
             
             # Set cookie
-            cookies["user"] = json.dumps(user_data)
-            cookies.save()
+            if cookies.ready():
+                cookies["user"] = _encode_session_cookie(user_data, token)
+                cookies.save()
             return True
         else:
             st.error("Incorrect password.")
@@ -202,12 +425,71 @@ def login_user(email: str, password: str) -> bool:
         st.error(f"Login failed: {str(e)}")
         return False
 
-# Initialize AI fitness advisor
-try:
-    healy = Healy() # Make sure Healy class is defined or imported
-except Exception as e:
-    st.error(f"Failed to initialize AI advisor: {str(e)}")
-    st.stop()
+# Custom CSS for fixed bottom input and styling. It has to be emitted on every
+# run - Streamlit drops elements a rerun doesn't re-render.
+CHAT_CSS = """
+<style>
+    /* Make the main content area scrollable with padding for fixed input */
+    .main .block-container {
+        padding-bottom: 180px !important; /* Increased padding for file uploader */
+        /* max-height: calc(100vh - 180px); Consider if needed, might conflict */
+        /* overflow-y: auto; This might be handled by Streamlit's chat elements better */
+    }
+    
+    /* Fix the input container at the bottom */
+    .fixed-bottom-input {
+        position: fixed;
+        bottom: 0;
+        left: 0; /* Adjust if sidebar exists and is not overlaid */
+        right: 0;
+        z-index: 999;
+        background: var(--background-color); /* Use Streamlit theme variables */
+        border-top: 1px solid var(--secondary-background-color);
+        padding: 1rem;
+        /* backdrop-filter: blur(10px); /* Optional: for frosted glass effect */
+    }
+    
+    /* Style the file uploader within the fixed input */
+    .fixed-bottom-input .stFileUploader > label {
+        font-size: 0.875rem; /* Smaller label */
+        color: var(--text-color);
+        margin-bottom: 0.25rem; /* Reduced margin */
+    }
+    
+    .fixed-bottom-input .stFileUploader > div > div > button { /* Target the button inside */
+        width: 100%;
+        /* height: 30px; /* Adjust button height if needed */
+        /* border-radius: 0.5rem; */
+        /* margin: 0; */
+    }
+    
+    /* Ensure chat messages are visible above the fixed input */
+    .stChatMessage {
+        margin-bottom: 1rem;
+    }
+    
+    /* Adjust sidebar to account for fixed input if it's not an overlay sidebar */
+    /* .css-1d391kg { /* Default Streamlit sidebar class, may change */
+    /* padding-bottom: 180px; /* Match fixed input height */
+    /* } */
+    
+    /* Dark mode adjustments */
+    @media (prefers-color-scheme: dark) {
+        .fixed-bottom-input {
+            background: rgba(14, 17, 23, 0.95); /* Darker, slightly transparent */
+            border-top-color: rgba(255, 255, 255, 0.1);
+        }
+    }
+    
+    /* Light mode adjustments */
+    @media (prefers-color-scheme: light) {
+        .fixed-bottom-input {
+            background: rgba(255, 255, 255, 0.95); /* Lighter, slightly transparent */
+            border-top-color: rgba(0, 0, 0, 0.1);
+        }
+    }
+</style>
+"""
 
 # Initialize session state from cookies if available
 if "logged_in" not in st.session_state:
@@ -218,46 +500,26 @@ if "logged_in" not in st.session_state:
         try:
             user_data_str = cookies["user"]
             if user_data_str: # Check if cookie is not empty
-                user_data = json.loads(user_data_str)
-                # Verify the user still exists in database
-                query = "SELECT * FROM c WHERE c.id = @id"
-                params = [{"name": "@id", "value": user_data["id"]}]
-                db_users = list(container.query_items(
-                    query=query,
-                    parameters=params,
-                    enable_cross_partition_query=True
-                ))
+                user_data = _decode_session_cookie(user_data_str)
+                # Verify the user still exists and the cookie's token is one we issued
+                fetched = _fetch_user_by_id(user_data["id"], _partition_key(user_data))
+                token = user_data.get("token", "")
+                if fetched and token and not _session_token_valid(token, fetched[1]):
+                    # The cached read may predate this login (e.g. made in another server process)
+                    fetched = _read_user(user_data["id"], _partition_key(user_data))
                 
-                if db_users:
+                if fetched and token and _session_token_valid(token, fetched[1]):
                     # Refresh session state with potentially updated data from DB (optional, or merge)
-                    db_user = db_users[0]
-                    st.session_state.user = { # Ensure all fields are present
-                        "id": db_user.get("id"),
-                        "username": db_user.get("username"),
-                        "email": db_user.get("email"),
-                        "birthdate": db_user.get("birthdate"),
-                        "weight": db_user.get("weight"),
-                        "height": db_user.get("height"),
-                        "health_metrics": db_user.get("health_metrics", {
-                            "initial_weight": db_user.get("weight"),
-                            "initial_height": db_user.get("height"),
-                            "progress": []
-                        })
-                    }
+                    st.session_state.user = fetched[0]
                     st.session_state.logged_in = True
-                else: # User not in DB, clear cookie
-                    del cookies["user"]
-                    cookies.save()
-        except json.JSONDecodeError:
+                    st.session_state.session_token = token
+        except ValueError: # Undecodable, including cookies from the old JSON format
             st.warning("Invalid user session cookie. Please login again.")
-            if "user" in cookies:
-                del cookies["user"]
-                cookies.save()
         except Exception as e: # Catch other potential errors during cookie load
             st.warning(f"Error loading session: {str(e)}. Please login again.")
-            if "user" in cookies:
-                del cookies["user"]
-                cookies.save()
+
+        if not st.session_state.logged_in: # Empty, unreadable, revoked, or the user is gone
+            _clear_cookie()
 
 
 # Sidebar for login/register
@@ -272,11 +534,18 @@ with st.sidebar:
         st.write(f"Height: {st.session_state.user.get('height', 'Not provided')} cm")
         
         if st.button("Logout"):
+            if st.session_state.get("session_token"):
+                try:
+                    _revoke_session_token(st.session_state.user, st.session_state.session_token)
+                except Exception:
+                    pass # The cookie is cleared below either way
+            st.session_state.session_token = None
             st.session_state.logged_in = False
             st.session_state.user = None
-            if "user" in cookies: # Check before deleting
-                del cookies["user"]
-                cookies.save()
+            st.session_state.user_context_prompt = None
+            _fetch_user_by_id.clear()
+            if cookies.ready():
+                _clear_cookie()
             # Clear other relevant session state if needed
             st.session_state.messages = [] 
             st.session_state.csv_data = None
@@ -341,84 +610,18 @@ if st.session_state.logged_in and st.session_state.user:
     st.title(f"AI Fitness Advisor")
     st.subheader(f"Hello, {st.session_state.user['username']}!")
     
-    # Chat interface with CSV storage
-    if "messages" not in st.session_state:
-        st.session_state.messages = []
-        st.session_state.messages.append({"role": "assistant", "content": "Hello! I'm your AI fitness advisor. How can I help you today?"})
+    # Chat, CSV storage and acknowledged-upload tracking defaults, in one pass.
+    # Built fresh each run so sessions never share the messages list.
+    for key, value in {
+        "messages": [{"role": "assistant", "content": "Hello! I'm your AI fitness advisor. How can I help you today?"}],
+        "csv_data": None,
+        "csv_info": None,
+        "last_uploaded_file_id": None,
+        "user_context_prompt": None
+    }.items():
+        st.session_state.setdefault(key, value)
     
-    # Initialize CSV data storage
-    if "csv_data" not in st.session_state:
-        st.session_state.csv_data = None
-        st.session_state.csv_info = None
-
-    # Initialize tracking for acknowledged file upload
-    if "last_uploaded_file_id" not in st.session_state:
-        st.session_state.last_uploaded_file_id = None
-    
-    # Custom CSS for fixed bottom input and styling
-    st.markdown("""
-    <style>
-        /* Make the main content area scrollable with padding for fixed input */
-        .main .block-container {
-            padding-bottom: 180px !important; /* Increased padding for file uploader */
-            /* max-height: calc(100vh - 180px); Consider if needed, might conflict */
-            /* overflow-y: auto; This might be handled by Streamlit's chat elements better */
-        }
-        
-        /* Fix the input container at the bottom */
-        .fixed-bottom-input {
-            position: fixed;
-            bottom: 0;
-            left: 0; /* Adjust if sidebar exists and is not overlaid */
-            right: 0;
-            z-index: 999;
-            background: var(--background-color); /* Use Streamlit theme variables */
-            border-top: 1px solid var(--secondary-background-color);
-            padding: 1rem;
-            /* backdrop-filter: blur(10px); /* Optional: for frosted glass effect */
-        }
-        
-        /* Style the file uploader within the fixed input */
-        .fixed-bottom-input .stFileUploader > label {
-            font-size: 0.875rem; /* Smaller label */
-            color: var(--text-color);
-            margin-bottom: 0.25rem; /* Reduced margin */
-        }
-        
-        .fixed-bottom-input .stFileUploader > div > div > button { /* Target the button inside */
-            width: 100%;
-            /* height: 30px; /* Adjust button height if needed */
-            /* border-radius: 0.5rem; */
-            /* margin: 0; */
-        }
-        
-        /* Ensure chat messages are visible above the fixed input */
-        .stChatMessage {
-            margin-bottom: 1rem;
-        }
-        
-        /* Adjust sidebar to account for fixed input if it's not an overlay sidebar */
-        /* .css-1d391kg { /* Default Streamlit sidebar class, may change */
-        /* padding-bottom: 180px; /* Match fixed input height */
-        /* } */
-        
-        /* Dark mode adjustments */
-        @media (prefers-color-scheme: dark) {
-            .fixed-bottom-input {
-                background: rgba(14, 17, 23, 0.95); /* Darker, slightly transparent */
-                border-top-color: rgba(255, 255, 255, 0.1);
-            }
-        }
-        
-        /* Light mode adjustments */
-        @media (prefers-color-scheme: light) {
-            .fixed-bottom-input {
-                background: rgba(255, 255, 255, 0.95); /* Lighter, slightly transparent */
-                border-top-color: rgba(0, 0, 0, 0.1);
-            }
-        }
-    </style>
-    """, unsafe_allow_html=True)
+    st.markdown(CHAT_CSS, unsafe_allow_html=True)
     
     # Display current CSV info if available
     if st.session_state.csv_data is not None and st.session_state.csv_info:
@@ -481,14 +684,16 @@ if st.session_state.logged_in and st.session_state.user:
                         st.session_state.csv_data = df
                         st.session_state.csv_info = csv_info_dict # Store the dict
                         
-                        csv_summary = f"📊 **CSV File Uploaded**: {csv_info_dict['filename']}\n\n"
-                        csv_summary += f"**Data Overview:**\n"
-                        csv_summary += f"- Shape: {csv_info_dict['shape'][0]} rows × {csv_info_dict['shape'][1]} columns\n"
-                        csv_summary += f"- Columns: {', '.join(csv_info_dict['columns'])}\n\n"
-                        csv_summary += "Your CSV data is now loaded! You can ask me questions about this data. For example:\n"
-                        csv_summary += "- 'Analyze my workout data'\n"
-                        csv_summary += "- 'Show me trends in my fitness metrics'\n"
-                        csv_summary += "- 'Create a summary of my progress based on the CSV'"
+                        csv_summary = "\n".join([
+                            f"📊 **CSV File Uploaded**: {csv_info_dict['filename']}\n",
+                            "**Data Overview:**",
+                            f"- Shape: {csv_info_dict['shape'][0]} rows × {csv_info_dict['shape'][1]} columns",
+                            f"- Columns: {', '.join(csv_info_dict['columns'])}\n",
+                            "Your CSV data is now loaded! You can ask me questions about this data. For example:",
+                            "- 'Analyze my workout data'",
+                            "- 'Show me trends in my fitness metrics'",
+                            "- 'Create a summary of my progress based on the CSV'"
+                        ])
                         
                         st.session_state.messages.append({"role": "assistant", "content": csv_summary})
                         st.rerun() # Rerun to display the message and update UI
@@ -496,7 +701,8 @@ if st.session_state.logged_in and st.session_state.user:
                         st.session_state.last_uploaded_file_id = None # Reset if processing failed
             else:
                 # For non-CSV, clear any existing CSV data to avoid confusion
-                if st.session_state.csv_data is not None:
+                csv_cleared = st.session_state.csv_data is not None
+                if csv_cleared:
                     st.toast("Note: Non-CSV file uploaded. Previous CSV data has been cleared for this chat.")
                     st.session_state.csv_data = None
                     st.session_state.csv_info = None
@@ -522,7 +728,13 @@ if st.session_state.logged_in and st.session_state.user:
                         response = f"Sorry, I encountered an error noting your file: {str(e)}"
                 
                 st.session_state.messages.append({"role": "assistant", "content": response})
-                st.rerun() # Rerun to display the message
+                if csv_cleared:
+                    st.rerun() # The loaded-CSV panel above is stale, redraw everything
+                # Otherwise just append the two new messages instead of rerunning the whole script
+                with chat_container:
+                    for message in st.session_state.messages[-2:]:
+                        with st.chat_message(message["role"]):
+                            st.markdown(message["content"])
         # If last_uploaded_file_id IS THE SAME as current_file_id, it means we've already
         # acknowledged this specific upload instance in an immediately preceding script run.
         # So, we do nothing here to prevent re-adding the acknowledgment.
@@ -531,63 +743,60 @@ if st.session_state.logged_in and st.session_state.user:
     # Handle chat input
     if prompt:
         st.session_state.messages.append({"role": "user", "content": prompt})
+        with chat_container:
+            with st.chat_message("user"):
+                st.markdown(prompt)
         
-        with st.spinner("Thinking..."):
-            try:
-                user_context = {
-                    "username": st.session_state.user['username'],
-                    "birthdate": st.session_state.user.get('birthdate'),
-                    "weight": st.session_state.user.get('weight'),
-                    "height": st.session_state.user.get('height'),
-                    "health_metrics": st.session_state.user.get('health_metrics')
-                }
-                
-                contextual_prompt_parts = [f"User profile:\n- Username: {user_context['username']}"]
-                if user_context['birthdate']:
-                    contextual_prompt_parts.append(f"- Birthdate: {user_context['birthdate']}")
-                if user_context['weight']:
-                    contextual_prompt_parts.append(f"- Weight: {user_context['weight']} kg")
-                if user_context['height']:
-                    contextual_prompt_parts.append(f"- Height: {user_context['height']} cm")
-                if user_context['health_metrics']:
-                     contextual_prompt_parts.append(f"- Health Metrics: {json.dumps(user_context['health_metrics'])}")
-
-
-                if st.session_state.csv_data is not None and st.session_state.csv_info is not None:
-                    # If CSV is loaded, assume the prompt might be about it.
-                    # The format_csv_for_prompt function now includes the user_question (prompt).
-                    csv_analysis_request = format_csv_for_prompt(
-                        st.session_state.csv_data, 
-                        st.session_state.csv_info, 
-                        prompt # Pass the user's actual question here
+        assistant_message = None
+        try:
+            # The profile block only changes when the profile does, build it once per session
+            if st.session_state.user_context_prompt is None:
+                st.session_state.user_context_prompt = get_healy().prepare_user_context(st.session_state.user)
+
+            if st.session_state.csv_data is not None and st.session_state.csv_info is not None:
+                # If CSV is loaded, assume the prompt might be about it.
+                # The format_csv_for_prompt function now includes the user_question (prompt).
+                question = format_csv_for_prompt(
+                    st.session_state.csv_data, 
+                    st.session_state.csv_info, 
+                    prompt # Pass the user's actual question here
+                )
+            else:
+                # Regular prompt without CSV data, or if the user is asking about a generic uploaded file
+                question = f"User question: {prompt}"
+                # If a non-CSV file was just uploaded, we could add a note here, but
+                # the AI should ideally use the chat history which includes the file upload message.
+            
+            # For non-CSV files, the AI needs to be instructed to look at the chat history
+            # if the prompt refers to a previously mentioned file.
+            # The `Healy` class's `generate_response` would need to handle chat history.
+            # For now, we're passing the file context (if CSV) or just the prompt.
+            # If you have a non-CSV file uploaded, you might need a different call to healy or
+            # ensure healy.generate_response can use st.session_state.messages for context.
+            # The placeholder "response" for non-CSV files above only acknowledges.
+            # The actual analysis of non-CSV files based on a subsequent prompt is not yet fully implemented here.
+            # It would require `healy.generate_response` to potentially accept image/pdf/text data or use a multimodal model.
+
+            with chat_container:
+                assistant_message = st.chat_message("assistant")
+                with assistant_message:
+                    response = stream_cached_response(
+                        question,
+                        st.session_state.user_context_prompt,
+                        st.session_state.messages[:-1] # Everything before the question just added
                     )
-                    contextual_prompt_parts.append(f"\n{csv_analysis_request}")
-                else:
-                    # Regular prompt without CSV data, or if the user is asking about a generic uploaded file
-                    contextual_prompt_parts.append(f"\nUser question: {prompt}")
-                    # If a non-CSV file was just uploaded, we could add a note here, but
-                    # the AI should ideally use the chat history which includes the file upload message.
-
-                final_contextual_prompt = "\n".join(contextual_prompt_parts)
-                
-                # For non-CSV files, the AI needs to be instructed to look at the chat history
-                # if the prompt refers to a previously mentioned file.
-                # The `Healy` class's `generate_response` would need to handle chat history.
-                # For now, we're passing the file context (if CSV) or just the prompt.
-                # If you have a non-CSV file uploaded, you might need a different call to healy or
-                # ensure healy.generate_response can use st.session_state.messages for context.
-                # The placeholder "response" for non-CSV files above only acknowledges.
-                # The actual analysis of non-CSV files based on a subsequent prompt is not yet fully implemented here.
-                # It would require `healy.generate_response` to potentially accept image/pdf/text data or use a multimodal model.
-
-                response = healy.generate_response(final_contextual_prompt) # Assuming Healy can take history
-                
-            except Exception as e:
-                response = f"Sorry, I encountered an error processing your request: {str(e)}"
-                st.error(f"Error details: {str(e)}") # Log error for debugging
+            
+        except Exception as e:
+            response = f"Sorry, I encountered an error processing your request: {str(e)}"
+            st.error(f"Error details: {str(e)}") # Log error for debugging
+            # Show the apology in the chat too, reusing the assistant bubble if it was already opened
+            if assistant_message is None:
+                with chat_container:
+                    assistant_message = st.chat_message("assistant")
+            assistant_message.markdown(response)
         
+        # Both messages are now rendered in chat_container, no rerun needed
         st.session_state.messages.append({"role": "assistant", "content": response})
-        st.rerun()
         
 else:
     st.title("AI Fitness Advisor")
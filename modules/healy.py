@@ -1,13 +1,40 @@
+import json
 from utils.azure_handler import AzureClient
 
 class Healy:
+    SYSTEM_MESSAGE = {"role": "system", "content": "You're a professional fitness advisor."}
+    HISTORY_MESSAGES = 8 # Recent chat messages sent along for context
+
     def __init__(self):
         self.ai = AzureClient()
+
+    def prepare_user_context(self, user):
+        """Build the user-profile block once per session; it is sent as a fixed prefix on every turn"""
+        parts = [f"User profile:\n- Username: {user['username']}"]
+        if user.get('birthdate'):
+            parts.append(f"- Birthdate: {user['birthdate']}")
+        if user.get('weight'):
+            parts.append(f"- Weight: {user['weight']} kg")
+        if user.get('height'):
+            parts.append(f"- Height: {user['height']} cm")
+        if user.get('health_metrics'):
+            parts.append(f"- Health Metrics: {json.dumps(user['health_metrics'])}")
+        return "\n".join(parts)
         
-    def generate_response(self, user_input):
-        messages = [
-            {"role": "system", "content": "You're a professional fitness advisor."},
-            {"role": "user", "content": user_input}
-        ]
-        return self.ai.get_response(messages)
-    
\ No newline at end of file
+    def _messages(self, user_input, user_context=None, history=None):
+        # Keep the static part of the prompt first and byte-identical across turns
+        # so Azure's prompt caching can reuse it; history only ever appends after it
+        messages = [self.SYSTEM_MESSAGE]
+        if user_context:
+            messages.append({"role": "system", "content": user_context})
+        for message in (history or [])[-self.HISTORY_MESSAGES:]:
+            messages.append({"role": message["role"], "content": message["content"]})
+        messages.append({"role": "user", "content": user_input})
+        return messages
+
+    def generate_response(self, user_input, user_context=None, history=None):
+        return self.ai.get_response(self._messages(user_input, user_context, history))
+
+    def stream_response(self, user_input, user_context=None, history=None):
+        """Yield the response in chunks as the model generates it"""
+        return self.ai.stream_response(self._messages(user_input, user_context, history))
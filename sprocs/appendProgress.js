@@ -0,0 +1,20 @@
+// Appends progress entries to a user's health_metrics in a single transaction,
+// so the client never has to re-send the existing history.
+function appendProgress(userId, entries) {
+    var collection = getContext().getCollection();
+    var response = getContext().getResponse();
+
+    var accepted = collection.readDocument(collection.getAltLink() + "/docs/" + userId, {}, function (err, doc) {
+        if (err) throw err;
+
+        doc.health_metrics = doc.health_metrics || {};
+        doc.health_metrics.progress = (doc.health_metrics.progress || []).concat(entries);
+
+        var replaced = collection.replaceDocument(doc._self, doc, function (err) {
+            if (err) throw err;
+            response.setBody(doc.health_metrics.progress.length);
+        });
+        if (!replaced) throw new Error("replaceDocument was not accepted, retry the call.");
+    });
+    if (!accepted) throw new Error("readDocument was not accepted, retry the call.");
+}
@@ -0,0 +1,22 @@
+// Records a login in one transaction: sets the given fields (last_login and,
+// when the password was rehashed, password_hash) and appends the session token
+// hash, keeping only the newest maxTokens. Reading the token list here rather
+// than on the client means concurrent logins can't overwrite each other.
+function recordLogin(userId, tokenHash, maxTokens, fields) {
+    var collection = getContext().getCollection();
+
+    var accepted = collection.readDocument(collection.getAltLink() + "/docs/" + userId, {}, function (err, doc) {
+        if (err) throw err;
+
+        for (var key in fields) {
+            doc[key] = fields[key];
+        }
+        doc.session_tokens = (doc.session_tokens || []).concat([tokenHash]).slice(-maxTokens);
+
+        var replaced = collection.replaceDocument(doc._self, doc, function (err) {
+            if (err) throw err;
+        });
+        if (!replaced) throw new Error("replaceDocument was not accepted, retry the call.");
+    });
+    if (!accepted) throw new Error("readDocument was not accepted, retry the call.");
+}
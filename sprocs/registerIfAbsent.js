@@ -0,0 +1,26 @@
+// Creates the user document unless one with the same email already exists.
+// Runs in the email's partition, so the check and the insert are one
+// transaction and one round-trip. Returns true if the user was created.
+function registerIfAbsent(userDoc) {
+    var collection = getContext().getCollection();
+    var response = getContext().getResponse();
+    var query = {
+        query: "SELECT TOP 1 c.id FROM c WHERE c.email = @email",
+        parameters: [{ name: "@email", value: userDoc.email }]
+    };
+
+    var accepted = collection.queryDocuments(collection.getSelfLink(), query, {}, function (err, results) {
+        if (err) throw err;
+        if (results.length > 0) {
+            response.setBody(false);
+            return;
+        }
+
+        var created = collection.createDocument(collection.getSelfLink(), userDoc, function (err) {
+            if (err) throw err;
+            response.setBody(true);
+        });
+        if (!created) throw new Error("createDocument was not accepted, retry the call.");
+    });
+    if (!accepted) throw new Error("queryDocuments was not accepted, retry the call.");
+}
@@ -0,0 +1,19 @@
+// Removes one session token hash from a user in a single transaction, so a
+// login landing at the same time keeps its token.
+function revokeSessionToken(userId, tokenHash) {
+    var collection = getContext().getCollection();
+
+    var accepted = collection.readDocument(collection.getAltLink() + "/docs/" + userId, {}, function (err, doc) {
+        if (err) throw err;
+
+        doc.session_tokens = (doc.session_tokens || []).filter(function (hash) {
+            return hash !== tokenHash;
+        });
+
+        var replaced = collection.replaceDocument(doc._self, doc, function (err) {
+            if (err) throw err;
+        });
+        if (!replaced) throw new Error("replaceDocument was not accepted, retry the call.");
+    });
+    if (!accepted) throw new Error("readDocument was not accepted, retry the call.");
+}
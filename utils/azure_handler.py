@@ -1,6 +1,9 @@
 import os
 from openai import AzureOpenAI
 
+# Upper bound on reply length; the service sizes its allocation by it
+MAX_COMPLETION_TOKENS = int(os.getenv("MAX_COMPLETION_TOKENS", "2048"))
+
 class AzureClient:
     def __init__(self):
         self.client = AzureOpenAI(
@@ -9,7 +12,7 @@ class AzureClient:
             api_key=os.getenv("AZURE_OPENAI_KEY")
         )
     
-    def get_response(self, messages, max_completion_tokens=100000):
+    def get_response(self, messages, max_completion_tokens=MAX_COMPLETION_TOKENS):
         try:
             response = self.client.chat.completions.create(
                 model=os.getenv("AZURE_OPENAI_DEPLOYMENT"),
@@ -19,4 +22,15 @@ class AzureClient:
             return response.choices[0].message.content
         except Exception as e:
             return f"Error: {str(e)}"
-        
\ No newline at end of file
+
+    def stream_response(self, messages, max_completion_tokens=MAX_COMPLETION_TOKENS):
+        """Yield the reply in chunks; errors are raised, possibly after some chunks were sent"""
+        stream = self.client.chat.completions.create(
+            model=os.getenv("AZURE_OPENAI_DEPLOYMENT"),
+            messages=messages,
+            max_completion_tokens=max_completion_tokens,
+            stream=True
+        )
+        for chunk in stream:
+            if chunk.choices: # Azure sends a leading chunk with only filter results
+                yield chunk.choices[0].delta.content or ""
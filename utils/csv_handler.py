@@ -0,0 +1,101 @@
+import io
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_numeric_dtype
+
+# Rows per chunk when reading uploaded CSVs; parsing memory scales with this
+# (the uploaded bytes themselves are still held in full)
+CSV_CHUNKSIZE = 100_000
+# Keep the CSV part of the prompt bounded for wide files
+CSV_WIDE_COLUMNS = 50
+CSV_WIDE_PREVIEW_ROWS = 3
+CSV_STATS_MAX_CHARS = 4096
+
+def parse_csv(bytes_payload: bytes):
+    """Summarise a CSV in one chunked pass, returns a preview DataFrame and the csv_info dict"""
+    head = None
+    rows = 0
+    dtypes = {}
+    null_counts = {}
+    running = {} # col -> (count, mean, M2, min, max), merged chunk by chunk (Chan et al.)
+    for chunk in pd.read_csv(io.BytesIO(bytes_payload), chunksize=CSV_CHUNKSIZE):
+        if head is None:
+            head = chunk.head()
+        rows += len(chunk)
+
+        for col, dtype in chunk.dtypes.items():
+            prev = dtypes.get(col, dtype)
+            if prev != dtype: # e.g. ints in one chunk, ints with blanks (floats) or text in the next
+                if is_numeric_dtype(prev) and is_numeric_dtype(dtype):
+                    dtype = np.dtype("float64")
+                else:
+                    dtype = np.dtype(object)
+            dtypes[col] = dtype
+        for col, count in chunk.isnull().sum().items():
+            null_counts[col] = null_counts.get(col, 0) + int(count)
+
+        for col in chunk.select_dtypes(include="number").columns:
+            values = chunk[col].dropna()
+            n_b = len(values)
+            if not n_b:
+                continue
+            mean_b = float(values.mean())
+            m2_b = float(((values - mean_b) ** 2).sum())
+            min_b, max_b = float(values.min()), float(values.max())
+            if col not in running:
+                running[col] = (n_b, mean_b, m2_b, min_b, max_b)
+                continue
+            n_a, mean_a, m2_a, min_a, max_a = running[col]
+            n = n_a + n_b
+            delta = mean_b - mean_a
+            running[col] = (
+                n,
+                mean_a + delta * n_b / n,
+                m2_a + m2_b + delta * delta * n_a * n_b / n,
+                min(min_a, min_b),
+                max(max_a, max_b)
+            )
+
+    if head is None: # Header only, no rows
+        head = pd.read_csv(io.BytesIO(bytes_payload), nrows=0)
+        dtypes = head.dtypes.to_dict()
+        null_counts = {col: 0 for col in head.columns}
+
+    summary_stats = {
+        col: {
+            "count": n,
+            "mean": mean,
+            "std": (m2 / (n - 1)) ** 0.5 if n > 1 else float("nan"),
+            "min": min_value,
+            "max": max_value
+        }
+        for col, (n, mean, m2, min_value, max_value) in running.items()
+        if is_numeric_dtype(dtypes[col]) # Skip columns that turned out to be mixed
+    }
+
+    # Render the prompt sections once here instead of on every chat turn
+    preview = head.head(CSV_WIDE_PREVIEW_ROWS) if len(head.columns) > CSV_WIDE_COLUMNS else head
+    summary_stats_str = pd.DataFrame(summary_stats).to_string() if summary_stats else ""
+    if len(summary_stats_str) > CSV_STATS_MAX_CHARS:
+        summary_stats_str = summary_stats_str[:CSV_STATS_MAX_CHARS] + "\n... (truncated)"
+    csv_info = {
+        "shape": (rows, len(head.columns)),
+        "columns": head.columns.tolist(),
+        # Text can come back as str or object depending on where chunks split, so
+        # report every non-numeric column as object to keep the prompt stable
+        "dtypes": {col: str(dtype) if is_numeric_dtype(dtype) else "object" for col, dtype in dtypes.items()},
+        "preview_rows": len(preview),
+        "head_str": preview.to_string(index=False),
+        "null_counts": null_counts,
+        "summary_stats_str": f"Summary Statistics:\n{summary_stats_str}" if summary_stats_str else "",
+        "categorical_columns": [col for col, dtype in dtypes.items() if not is_numeric_dtype(dtype)]
+    }
+    return head, csv_info
+
+def top_values(bytes_payload: bytes, column: str, n: int = 3) -> dict:
+    """Most common values of one column, read in chunks"""
+    counts = {}
+    for chunk in pd.read_csv(io.BytesIO(bytes_payload), usecols=[column], chunksize=CSV_CHUNKSIZE):
+        for value, count in chunk[column].value_counts().items():
+            counts[str(value)] = counts.get(str(value), 0) + int(count)
+    return dict(sorted(counts.items(), key=lambda item: item[1], reverse=True)[:n])
@@ -0,0 +1,51 @@
+"""Copy the users container into a new container partitioned on /email.
+
+Cosmos can't change a container's partition key in place, so this copies
+every user from CONTAINER_NAME into TARGET (default "<CONTAINER_NAME>-email")
+and leaves the source untouched. Point CONTAINER_NAME at TARGET afterwards.
+
+    python -m utils.migrate_partition_key [TARGET]
+"""
+import os
+import sys
+from dotenv import load_dotenv
+from azure.cosmos import CosmosClient, PartitionKey, exceptions
+
+# Server-generated fields, recreated on insert
+SYSTEM_FIELDS = ("_rid", "_self", "_etag", "_attachments", "_ts")
+
+def migrate(target_name=None):
+    """Copy every user into the /email container, returns (target id, copied count, skipped ids)"""
+    client = CosmosClient(os.getenv("COSMOS_URI"), credential=os.getenv("COSMOS_KEY"))
+    database = client.get_database_client(os.getenv("DATABASE_NAME"))
+    source = database.get_container_client(os.getenv("CONTAINER_NAME"))
+    target = database.create_container_if_not_exists(
+        id=target_name or f"{source.id}-email",
+        partition_key=PartitionKey(path="/email"),
+        unique_key_policy={"uniqueKeys": [{"paths": ["/email"]}]}
+    )
+    paths = target.read()["partitionKey"]["paths"]
+    if paths != ["/email"]:
+        raise RuntimeError(f"target container '{target.id}' is partitioned on {paths}, expected ['/email']")
+
+    copied, skipped = 0, []
+    # Oldest first, so if an email was registered twice the original account is kept
+    query = "SELECT * FROM c ORDER BY c._ts"
+    for item in source.query_items(query=query, enable_cross_partition_query=True):
+        doc = {key: value for key, value in item.items() if key not in SYSTEM_FIELDS}
+        if not doc.get("email"):
+            skipped.append(doc["id"])
+            continue
+        try:
+            target.create_item(body=doc)
+            copied += 1
+        except exceptions.CosmosResourceExistsError: # Already copied, or a duplicate email
+            skipped.append(doc["id"])
+    return target.id, copied, skipped
+
+if __name__ == "__main__":
+    load_dotenv()
+    target_id, copied, skipped = migrate(sys.argv[1] if len(sys.argv) > 1 else None)
+    print(f"Copied {copied} users into '{target_id}'.")
+    if skipped:
+        print(f"Skipped {len(skipped)} (already copied, duplicate or missing email): {', '.join(skipped)}")
@@ -0,0 +1,80 @@
+import os
+import queue
+import base64
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import bcrypt
+from cachetools import TTLCache
+
+# bcrypt work factor. Each +1 doubles the CPU per hash/check; 10 keeps a
+# login around 80 ms instead of ~300 ms at the library default of 12, at
+# the cost of making offline brute force of a leaked hash 4x cheaper.
+# Raise it via BCRYPT_ROUNDS (BCRYPT_COST is still read as a fallback) if
+# the deployment has CPU to spare. Existing hashes keep verifying whatever
+# their cost, since bcrypt reads it from the hash prefix.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", os.getenv("BCRYPT_COST", "10")))
+
+# bcrypt releases the GIL while hashing, so a shared pool lets concurrent
+# logins/registrations across sessions run on separate cores
+_pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="bcrypt")
+
+# Salts are drawn from the OS CSPRNG in batches and handed out from a queue,
+# refilled in the background when it runs low
+SALT_BATCH = 64
+SALT_REFILL_THRESHOLD = 16
+_salt_queue = queue.SimpleQueue()
+_refill_lock = threading.Lock()
+
+# bcrypt uses standard base64 bit order with its own alphabet
+_BCRYPT_B64 = bytes.maketrans(
+    b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/",
+    b"./ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
+)
+
+def _refill_salts():
+    try:
+        raw = os.urandom(16 * SALT_BATCH)
+        for i in range(0, len(raw), 16):
+            _salt_queue.put(raw[i:i + 16])
+    finally:
+        _refill_lock.release()
+
+def _next_salt() -> bytes:
+    if _salt_queue.qsize() < SALT_REFILL_THRESHOLD and _refill_lock.acquire(blocking=False):
+        threading.Thread(target=_refill_salts, daemon=True).start()
+    try:
+        raw = _salt_queue.get_nowait()
+    except queue.Empty:
+        raw = os.urandom(16) # Pool drained, don't wait for the refill
+    return b"$2b$%02d$" % BCRYPT_ROUNDS + base64.b64encode(raw)[:22].translate(_BCRYPT_B64)
+
+def hash_password_async(password: str):
+    """Start hashing on the bcrypt pool and return the Future"""
+    return _pool.submit(bcrypt.hashpw, password.encode('utf-8'), _next_salt())
+
+def hash_password(password: str) -> bytes:
+    return hash_password_async(password).result()
+
+def needs_rehash(hashed: bytes) -> bool:
+    # Hashes look like b"$2b$12$...", the cost is the second field
+    return int(hashed.split(b"$")[2]) != BCRYPT_ROUNDS
+
+# Successful verifications are remembered briefly so repeat logins skip
+# bcrypt. Keys are sha256(password + stored hash), never the plaintext, and
+# the short TTL limits what a process memory dump could reveal. Failures
+# aren't cached so guessing can't fill the cache.
+VERIFY_CACHE_TTL = 300 # seconds
+_verified = TTLCache(maxsize=1024, ttl=VERIFY_CACHE_TTL)
+_verified_lock = threading.Lock()
+
+def check_password(password: str, hashed: bytes) -> bool:
+    key = hashlib.sha256(password.encode('utf-8') + hashed).digest()
+    with _verified_lock:
+        if key in _verified:
+            return True
+    if not _pool.submit(bcrypt.checkpw, password.encode('utf-8'), hashed).result():
+        return False
+    with _verified_lock:
+        _verified[key] = True
+    return True